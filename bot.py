@@ -1,7 +1,11 @@
 import os
 import math
+import time
+import asyncio
+import logging
+from collections import OrderedDict
 from dataclasses import dataclass
-from typing import Optional, Dict, Tuple, Any
+from typing import Optional, Dict, List, Tuple, Any
 
 from telegram import (
     Update,
@@ -14,6 +18,7 @@ from telegram.ext import (
     CallbackQueryHandler,
     ConversationHandler,
     MessageHandler,
+    TypeHandler,
     ContextTypes,
     filters,
 )
@@ -382,6 +387,18 @@ def calc_delivery(
 # 2) TELEGRAM BOT: кнопки + пошаговый ввод
 # ==========================================================
 
+logger = logging.getLogger(__name__)
+
+# Брошенные расчёты: через CONVERSATION_TIMEOUT секунд без ответа диалог завершается,
+# а user_data пользователей, молчащих дольше USER_DATA_TTL, вычищает фоновая задача.
+# Таймаут срабатывает чуть позже последней отметки активности, поэтому add_handlers держит
+# USER_DATA_TTL не меньше CONVERSATION_TIMEOUT + SWEEP_INTERVAL, чтобы уборка не задела живые диалоги.
+CONVERSATION_TIMEOUT = float(os.environ.get("CONVERSATION_TIMEOUT", 15 * 60))
+USER_DATA_TTL = float(os.environ.get("USER_DATA_TTL", 30 * 60))
+USER_DATA_MAX_ENTRIES = int(os.environ.get("USER_DATA_MAX_ENTRIES", 50_000))
+SWEEP_INTERVAL = float(os.environ.get("SWEEP_INTERVAL", 60))
+SWEEP_BATCH = 500
+
 CHOOSE_DELIVERY, CARGO_TYPE, CUSTOMS_TYPE, ASK_DAYS, ASK_WEIGHT, ASK_VOLUME, ASK_HAS_VALUE, ASK_VALUE, SHOW_RESULT = range(9)
 
 def kb(rows):
@@ -418,12 +435,34 @@ def yes_no_value_keyboard():
         [InlineKeyboardButton("⬅️ Назад", callback_data="restart")],
     ])
 
+def end_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    # Данные расчёта после завершения диалога больше не нужны.
+    # Не через context.user_data: он заново создал бы запись, уже выселенную уборкой
+    user_id = update.effective_user.id
+    user_data = context.application.user_data.get(user_id)
+    if user_data is not None:
+        user_data.clear()
+    context.bot_data["live"].discard(user_id)
+    return ConversationHandler.END
+
+async def session_lost(update: Update, context: ContextTypes.DEFAULT_TYPE, key: str) -> bool:
+    # user_data могли выселить посреди диалога (лимит записей) — не считаем на None
+    if key in context.user_data:
+        return False
+    text = "⌛ Данные расчёта устарели. Нажми /start, чтобы начать заново."
+    if update.callback_query:
+        await update.callback_query.edit_message_text(text)
+    else:
+        await update.message.reply_text(text)
+    return True
+
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = (
         "Привет! Я калькулятор доставки.\n\n"
         "Выбери тип доставки кнопкой ниже 👇"
     )
     await update.message.reply_text(text, reply_markup=start_keyboard())
+    context.bot_data["live"].add(update.effective_user.id)
     return CHOOSE_DELIVERY
 
 async def on_restart(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -431,6 +470,7 @@ async def on_restart(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     context.user_data.clear()
     await query.edit_message_text("Ок, новый расчёт. Выбери тип доставки 👇", reply_markup=start_keyboard())
+    context.bot_data["live"].add(update.effective_user.id)
     return CHOOSE_DELIVERY
 
 async def choose_delivery(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -449,11 +489,13 @@ async def choose_delivery(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return CUSTOMS_TYPE
 
     await query.edit_message_text("Не понял выбор. Нажми /start заново.")
-    return ConversationHandler.END
+    return end_conversation(update, context)
 
 async def choose_cargo_type(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
+    if await session_lost(update, context, "delivery"):
+        return end_conversation(update, context)
 
     if query.data.startswith("cargo_type:"):
         cargo_type = query.data.split(":", 1)[1]
@@ -467,11 +509,13 @@ async def choose_cargo_type(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await on_restart(update, context)
 
     await query.edit_message_text("Не понял тип товара. Нажми /start.")
-    return ConversationHandler.END
+    return end_conversation(update, context)
 
 async def choose_customs(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
+    if await session_lost(update, context, "delivery"):
+        return end_conversation(update, context)
 
     if query.data == "customs:us":
         context.user_data["customs_on_us"] = True
@@ -481,12 +525,14 @@ async def choose_customs(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await on_restart(update, context)
     else:
         await query.edit_message_text("Не понял выбор. Нажми /start.")
-        return ConversationHandler.END
+        return end_conversation(update, context)
 
     await query.edit_message_text("Введи желаемый срок доставки (дней), например: 15")
     return ASK_DAYS
 
 async def ask_days(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if await session_lost(update, context, "delivery"):
+        return end_conversation(update, context)
     txt = (update.message.text or "").strip()
     try:
         days = int(txt)
@@ -501,6 +547,8 @@ async def ask_days(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ASK_WEIGHT
 
 async def ask_weight(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if await session_lost(update, context, "days"):
+        return end_conversation(update, context)
     txt = (update.message.text or "").strip().replace(",", ".")
     try:
         w = float(txt)
@@ -515,6 +563,8 @@ async def ask_weight(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ASK_VOLUME
 
 async def ask_volume(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if await session_lost(update, context, "weight"):
+        return end_conversation(update, context)
     txt = (update.message.text or "").strip().replace(",", ".")
     try:
         v = float(txt)
@@ -537,6 +587,8 @@ async def ask_volume(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def ask_has_value(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
+    if await session_lost(update, context, "volume"):
+        return end_conversation(update, context)
 
     if query.data == "has_value:yes":
         context.user_data["has_value"] = True
@@ -553,9 +605,11 @@ async def ask_has_value(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await on_restart(update, context)
 
     await query.edit_message_text("Не понял. Нажми /start.")
-    return ConversationHandler.END
+    return end_conversation(update, context)
 
 async def ask_value(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if await session_lost(update, context, "volume"):
+        return end_conversation(update, context)
     txt = (update.message.text or "").strip().replace(",", ".")
     try:
         val = float(txt)
@@ -616,7 +670,7 @@ async def show_result_from_data(update: Update, context: ContextTypes.DEFAULT_TY
             await update.callback_query.edit_message_text(msg, reply_markup=back_to_start_keyboard())
         else:
             await update.message.reply_text(msg, reply_markup=back_to_start_keyboard())
-        return ConversationHandler.END
+        return end_conversation(update, context)
 
     text = format_result(res)
 
@@ -625,18 +679,124 @@ async def show_result_from_data(update: Update, context: ContextTypes.DEFAULT_TY
     else:
         await update.message.reply_text(text, reply_markup=back_to_start_keyboard())
 
-    return ConversationHandler.END
-
-
-def build_app() -> Application:
-    token = os.environ.get("BOT_TOKEN")
-    if not token:
-        raise RuntimeError("Не задан BOT_TOKEN. Пример: $env:BOT_TOKEN=\"...\"")
+    return end_conversation(update, context)
+
+
+# ---------- Учёт активности и уборка user_data ----------
+
+async def on_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.bot_data["metrics"]["timed_out"] += 1
+    end_conversation(update, context)
+
+async def touch_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if user is None:
+        return
+    # OrderedDict: самые давно молчавшие пользователи всегда в начале
+    last_seen = context.bot_data["last_seen"]
+    last_seen[user.id] = time.monotonic()
+    last_seen.move_to_end(user.id)
+
+def _evict(app: Application, user_id: int) -> bool:
+    app.bot_data["last_seen"].pop(user_id, None)
+    if user_id not in app.user_data:
+        return False
+    app.drop_user_data(user_id)
+    return True
+
+def _cap_victims(app: Application) -> List[Tuple[int, Optional[float]]]:
+    # Кандидаты — только реальные записи user_data, вместе с отметкой активности на момент выбора.
+    # Порядок: записи без отметки, затем самые давние завершённые диалоги, затем живые
+    user_data = app.user_data
+    last_seen = app.bot_data["last_seen"]
+    live = app.bot_data["live"]
+    tracked = [(user_id, seen) for user_id, seen in last_seen.items() if user_id in user_data]
+    return (
+        [(user_id, None) for user_id in user_data if user_id not in last_seen]
+        + [(user_id, seen) for user_id, seen in tracked if user_id not in live]
+        + [(user_id, seen) for user_id, seen in tracked if user_id in live]
+    )
 
-    app = Application.builder().token(token).build()
+async def sweep_user_data(context: ContextTypes.DEFAULT_TYPE):
+    app = context.application
+    ttl, max_entries, batch = context.job.data
+    last_seen = app.bot_data["last_seen"]
+    metrics = app.bot_data["metrics"]
+
+    # Выселяем пачками и отдаём управление циклу между ними, чтобы не тормозить апдейты
+    cutoff = time.monotonic() - ttl
+    steps = 0
+    while last_seen:
+        user_id, seen = next(iter(last_seen.items()))
+        if seen > cutoff:
+            break
+        if _evict(app, user_id):
+            metrics["evicted_idle"] += 1
+        steps += 1
+        if steps % batch == 0:
+            await asyncio.sleep(0)
+
+    # Жёсткий лимит: сначала самые давние завершённые диалоги, живые — только если не хватило.
+    # Живой диалог после этого сам сбросится на /start через session_lost.
+    while len(app.user_data) > max_entries:
+        evicted = 0
+        for user_id, seen in _cap_victims(app):
+            if len(app.user_data) <= max_entries:
+                break
+            # Пока отдавали управление, пользователь мог написать снова — тогда список устарел
+            if last_seen.get(user_id) != seen:
+                continue
+            if _evict(app, user_id):
+                metrics["evicted_cap"] += 1
+                evicted += 1
+                if evicted % batch == 0:
+                    await asyncio.sleep(0)
+        if not evicted:
+            break
+
+    logger.info("user_data sweep: %s", user_data_metrics(app))
+
+def user_data_metrics(app: Application) -> Dict[str, int]:
+    metrics = dict(app.bot_data["metrics"])
+    metrics["live_conversations"] = len(app.bot_data["live"])
+    metrics["user_data_entries"] = len(app.user_data)
+    return metrics
+
+
+def add_handlers(
+    app: Application,
+    conversation_timeout: float = CONVERSATION_TIMEOUT,
+    user_data_ttl: float = USER_DATA_TTL,
+    user_data_max_entries: int = USER_DATA_MAX_ENTRIES,
+    sweep_interval: float = SWEEP_INTERVAL,
+) -> None:
+    if app.job_queue is None:
+        raise RuntimeError("Нужен JobQueue: pip install \"python-telegram-bot[job-queue]\"")
+
+    min_ttl = conversation_timeout + sweep_interval
+    if user_data_ttl < min_ttl:
+        logger.warning(
+            "USER_DATA_TTL=%s меньше CONVERSATION_TIMEOUT + SWEEP_INTERVAL=%s, поднимаю до него",
+            user_data_ttl, min_ttl,
+        )
+        user_data_ttl = min_ttl
+
+    app.bot_data["last_seen"] = OrderedDict()
+    # id пользователей с незавершённым диалогом: от /start или «Новый расчёт» до end_conversation
+    app.bot_data["live"] = set()
+    app.bot_data["metrics"] = {
+        "timed_out": 0,
+        "evicted_idle": 0,
+        "evicted_cap": 0,
+    }
+    app.add_handler(TypeHandler(Update, touch_user), group=-1)
 
     conv = ConversationHandler(
-        entry_points=[CommandHandler("start", cmd_start)],
+        entry_points=[
+            CommandHandler("start", cmd_start),
+            # «Новый расчёт» под результатом тоже открывает диалог
+            CallbackQueryHandler(on_restart, pattern="^restart$"),
+        ],
         states={
             CHOOSE_DELIVERY: [
                 CallbackQueryHandler(on_restart, pattern="^restart$"),
@@ -658,19 +818,38 @@ def build_app() -> Application:
                 CallbackQueryHandler(ask_has_value, pattern="^has_value:(yes|no)$"),
             ],
             ASK_VALUE: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_value)],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, on_timeout)],
         },
         fallbacks=[CommandHandler("start", cmd_start)],
         allow_reentry=True,
+        conversation_timeout=conversation_timeout,
     )
 
     app.add_handler(conv)
-    # На всякий: если нажали "Новый расчёт" после результата
-    app.add_handler(CallbackQueryHandler(on_restart, pattern="^restart$"))
 
+    app.job_queue.run_repeating(
+        sweep_user_data,
+        interval=sweep_interval,
+        first=sweep_interval,
+        data=(user_data_ttl, user_data_max_entries, SWEEP_BATCH),
+        name="sweep_user_data",
+    )
+
+
+def build_app() -> Application:
+    token = os.environ.get("BOT_TOKEN")
+    if not token:
+        raise RuntimeError("Не задан BOT_TOKEN. Пример: $env:BOT_TOKEN=\"...\"")
+
+    app = Application.builder().token(token).build()
+    add_handlers(app)
     return app
 
 
 def main():
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s", level=logging.INFO)
+    # httpx пишет каждый запрос к Bot API на INFO
+    logging.getLogger("httpx").setLevel(logging.WARNING)
     app = build_app()
     app.run_polling()
 
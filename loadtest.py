@@ -0,0 +1,412 @@
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import random
+import sys
+import time
+from collections import defaultdict
+from typing import Optional, Dict, List, Tuple, Any
+from urllib.parse import parse_qsl
+
+from telegram import Update
+from telegram.ext import Application
+
+from bot import (
+    RATES,
+    CONVERSATION_TIMEOUT,
+    USER_DATA_TTL,
+    USER_DATA_MAX_ENTRIES,
+    SWEEP_INTERVAL,
+    add_handlers,
+    user_data_metrics,
+)
+
+# ==========================================================
+# 1) ФЕЙКОВЫЙ TELEGRAM BOT API
+# ==========================================================
+
+FAKE_TOKEN = "123456:LOADTEST"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "CalcBot", "username": "calc_loadtest_bot"}
+
+
+class FakeBotAPI:
+    """Минимальный HTTP/1.1 сервер, отвечающий как api.telegram.org.
+
+    Каждый sendMessage/editMessageText будит виртуального пользователя,
+    который ждёт ответа бота в своём чате.
+    """
+
+    def __init__(self, api_latency: float = 0.0):
+        self.api_latency = api_latency
+        self.calls: Dict[str, int] = defaultdict(int)
+        self.waiters: Dict[int, asyncio.Future] = {}
+        self._message_ids = itertools.count(1)
+        self._server: Optional[asyncio.AbstractServer] = None
+        self.port = 0
+
+    async def start(self, host: str = "127.0.0.1") -> None:
+        self._server = await asyncio.start_server(self._handle_conn, host, 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    def expect_reply(self, chat_id: int) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        self.waiters[chat_id] = fut
+        return fut
+
+    async def _handle_conn(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                _, path, _ = request_line.decode("latin-1").split(" ", 2)
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                params = {k: _maybe_json(v) for k, v in parse_qsl(body.decode("utf-8"))}
+
+                method = path.rsplit("/", 1)[-1]
+                self.calls[method] += 1
+                if self.api_latency:
+                    await asyncio.sleep(self.api_latency)
+
+                payload = json.dumps({"ok": True, "result": self._dispatch(method, params)}).encode("utf-8")
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\n"
+                    b"Content-Type: application/json\r\n"
+                    + f"Content-Length: {len(payload)}\r\n\r\n".encode("latin-1")
+                    + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _dispatch(self, method: str, params: Dict[str, Any]) -> Any:
+        if method == "getMe":
+            return BOT_USER
+        if method in ("sendMessage", "editMessageText"):
+            chat_id = int(params["chat_id"])
+            message_id = int(params.get("message_id") or next(self._message_ids))
+            fut = self.waiters.pop(chat_id, None)
+            if fut is not None and not fut.done():
+                fut.set_result((message_id, params.get("text", "")))
+            return {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+        # answerCallbackQuery, deleteWebhook и прочее
+        return True
+
+
+def _maybe_json(value: str) -> Any:
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+# ==========================================================
+# 2) ВИРТУАЛЬНЫЕ ПОЛЬЗОВАТЕЛИ
+# ==========================================================
+
+CARGO_TYPES = sorted({ct for (ct, _) in RATES.keys()})
+INVALID_INPUTS = ["abc", "-5", "1e", "пятнадцать"]
+
+
+class SessionReset(Exception):
+    pass
+
+
+class Stats:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.updates_sent = 0
+        self.flows_completed = 0
+        self.flows_abandoned = 0
+        self.calc_errors = 0
+        self.sessions_reset = 0
+        self.user_data_samples: List[Tuple[float, int, int]] = []
+
+
+class VirtualUser:
+    _update_ids = itertools.count(1)
+
+    def __init__(self, uid: int, app: Application, api: FakeBotAPI, stats: Stats, args, rnd: random.Random):
+        self.uid = uid
+        self.app = app
+        self.api = api
+        self.stats = stats
+        self.args = args
+        self.rnd = rnd
+        self.message_id = 0
+        self.user = {"id": uid, "is_bot": False, "first_name": f"user{uid}"}
+        self.chat = {"id": uid, "type": "private"}
+
+    def _message(self, text: str) -> Dict[str, Any]:
+        message = {
+            "message_id": 0,
+            "date": int(time.time()),
+            "chat": self.chat,
+            "from": self.user,
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": next(self._update_ids), "message": message}
+
+    def _callback(self, data: str) -> Dict[str, Any]:
+        return {
+            "update_id": next(self._update_ids),
+            "callback_query": {
+                "id": str(next(self._update_ids)),
+                "from": self.user,
+                "chat_instance": str(self.uid),
+                "data": data,
+                "message": {
+                    "message_id": self.message_id,
+                    "date": int(time.time()),
+                    "chat": self.chat,
+                    "from": BOT_USER,
+                    "text": "",
+                },
+            },
+        }
+
+    async def _step(self, name: str, payload: Dict[str, Any]) -> str:
+        if self.args.think_time:
+            await asyncio.sleep(self.rnd.expovariate(1.0 / self.args.think_time))
+
+        fut = self.api.expect_reply(self.uid)
+        t0 = time.perf_counter()
+        await self.app.update_queue.put(Update.de_json(payload, self.app.bot))
+        self.stats.updates_sent += 1
+        try:
+            self.message_id, text = await asyncio.wait_for(fut, self.args.step_timeout)
+        except asyncio.TimeoutError:
+            self.api.waiters.pop(self.uid, None)
+            self.stats.errors[f"timeout:{name}"] += 1
+            raise
+        self.stats.latencies[name].append(time.perf_counter() - t0)
+        if text.startswith("⌛"):
+            # user_data выселили посреди диалога — бот отправил пользователя на /start
+            raise SessionReset
+        return text
+
+    async def _text_step(self, name: str, valid: str) -> str:
+        if self.rnd.random() < self.args.invalid_ratio:
+            await self._step(f"{name}(invalid)", self._message(self.rnd.choice(INVALID_INPUTS)))
+        return await self._step(name, self._message(valid))
+
+    def _abandons(self) -> bool:
+        if self.rnd.random() < self.args.abandon_ratio:
+            self.stats.flows_abandoned += 1
+            return True
+        return False
+
+    async def run(self) -> None:
+        try:
+            await self._step("start", self._message("/start"))
+
+            white = self.rnd.random() < self.args.white_ratio
+            if white:
+                await self._step("delivery", self._callback("delivery:white"))
+                await self._step("customs", self._callback(self.rnd.choice(["customs:us", "customs:client"])))
+            else:
+                await self._step("delivery", self._callback("delivery:cargo"))
+                await self._step("cargo_type", self._callback(f"cargo_type:{self.rnd.choice(CARGO_TYPES)}"))
+
+            await self._text_step("days", str(self.rnd.randint(10, 30)))
+            if self._abandons():
+                return
+            await self._text_step("weight", str(self.rnd.randint(50, 1000)))
+            if self._abandons():
+                return
+            text = await self._text_step("volume", f"{self.rnd.uniform(0.3, 3.0):.2f}")
+
+            if white:
+                if self.rnd.random() < 0.5:
+                    await self._step("has_value", self._callback("has_value:yes"))
+                    text = await self._text_step("value", str(self.rnd.randint(100, 50000)))
+                else:
+                    text = await self._step("has_value", self._callback("has_value:no"))
+
+            if text.startswith("❌"):
+                self.stats.calc_errors += 1
+            self.stats.flows_completed += 1
+        except asyncio.TimeoutError:
+            pass
+        except SessionReset:
+            self.stats.sessions_reset += 1
+        except Exception as e:
+            self.stats.errors[type(e).__name__] += 1
+
+
+# ==========================================================
+# 3) ЗАПУСК И ОТЧЁТ
+# ==========================================================
+
+def approx_size(obj: Any, _seen: Optional[set] = None) -> int:
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(approx_size(k, _seen) + approx_size(v, _seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(approx_size(x, _seen) for x in obj)
+    return size
+
+
+async def sample_user_data(app: Application, stats: Stats, t_start: float, interval: float) -> None:
+    while True:
+        user_data = app.user_data
+        stats.user_data_samples.append((time.perf_counter() - t_start, len(user_data), approx_size(dict(user_data))))
+        await asyncio.sleep(interval)
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    # Метод ближайшего ранга
+    idx = max(0, math.ceil(q / 100 * len(sorted_values)) - 1)
+    return sorted_values[idx]
+
+
+def print_report(stats: Stats, api: FakeBotAPI, metrics: Dict[str, int], elapsed: float, args) -> None:
+    print(f"\nПользователей: {args.users}, интенсивность: {args.rate}/с, длительность: {elapsed:.2f} с"
+          + (f" (+ ожидание {args.linger:.2f} с)" if args.linger else ""))
+    print(f"Апдейтов отправлено: {stats.updates_sent} ({stats.updates_sent / elapsed:.1f} апд/с)")
+    print(f"Сценариев завершено: {stats.flows_completed}, брошено: {stats.flows_abandoned}, "
+          f"ошибок расчёта: {stats.calc_errors}, сброшено выселением: {stats.sessions_reset}")
+    print(f"Вызовов Bot API: {dict(api.calls)}")
+
+    print(f"\n{'шаг':<20}{'n':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'max, мс':>10}")
+    for name, values in sorted(stats.latencies.items()):
+        values.sort()
+        row = [percentile(values, q) * 1000 for q in (50, 95, 99)] + [values[-1] * 1000]
+        print(f"{name:<20}{len(values):>8}" + "".join(f"{x:>10.2f}" for x in row))
+
+    if stats.user_data_samples:
+        first, last = stats.user_data_samples[0], stats.user_data_samples[-1]
+        peak = max(stats.user_data_samples, key=lambda s: s[2])
+        print(f"\nuser_data: записей {first[1]} → {last[1]} (пик {peak[1]}), "
+              f"≈{first[2] / 1024:.1f} → {last[2] / 1024:.1f} КиБ (пик {peak[2] / 1024:.1f} КиБ)")
+
+    print(f"Уборка user_data: {metrics}")
+
+    if stats.errors:
+        print(f"\nОшибки: {dict(stats.errors)}")
+    else:
+        print("\nОшибок нет")
+
+
+async def run(args) -> None:
+    api = FakeBotAPI(api_latency=args.api_latency / 1000)
+    await api.start()
+
+    app = (
+        Application.builder()
+        .token(FAKE_TOKEN)
+        .base_url(api.base_url)
+        .updater(None)
+        .concurrent_updates(args.concurrent_updates)
+        .build()
+    )
+    add_handlers(
+        app,
+        conversation_timeout=args.conversation_timeout,
+        user_data_ttl=args.user_data_ttl,
+        user_data_max_entries=args.user_data_max,
+        sweep_interval=args.sweep_interval,
+    )
+
+    stats = Stats()
+    rnd = random.Random(args.seed)
+
+    async with app:
+        await app.start()
+        t_start = time.perf_counter()
+        sampler = asyncio.create_task(sample_user_data(app, stats, t_start, args.sample_interval))
+
+        tasks = []
+        for i in range(args.users):
+            user = VirtualUser(10_000_000 + i, app, api, stats, args, random.Random(rnd.random()))
+            tasks.append(asyncio.create_task(user.run()))
+            if args.rate > 0:
+                await asyncio.sleep(rnd.expovariate(args.rate))
+        await asyncio.gather(*tasks)
+        # Пропускную способность считаем без ожидания ниже
+        elapsed = time.perf_counter() - t_start
+
+        # Даём сработать таймаутам диалогов и уборщику user_data
+        await asyncio.sleep(args.linger)
+
+        sampler.cancel()
+        stats.user_data_samples.append(
+            (time.perf_counter() - t_start, len(app.user_data), approx_size(dict(app.user_data)))
+        )
+        metrics = user_data_metrics(app)
+        await app.stop()
+
+    await api.stop()
+    print_report(stats, api, metrics, elapsed, args)
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Нагрузочный тест бота на фейковом Bot API")
+    p.add_argument("--users", type=int, default=1000, help="сколько виртуальных пользователей запустить")
+    p.add_argument("--rate", type=float, default=200.0, help="новых пользователей в секунду (0 = все сразу)")
+    p.add_argument("--white-ratio", type=float, default=0.3, help="доля сценариев белой доставки")
+    p.add_argument("--invalid-ratio", type=float, default=0.1, help="вероятность неверного ввода на текстовом шаге")
+    p.add_argument("--abandon-ratio", type=float, default=0.0, help="вероятность бросить сценарий после срока/веса")
+    p.add_argument("--think-time", type=float, default=0.0, help="средняя пауза пользователя между шагами, с")
+    p.add_argument("--api-latency", type=float, default=0.0, help="задержка ответа фейкового Bot API, мс")
+    p.add_argument("--concurrent-updates", type=int, default=1,
+                   help="сколько апдейтов бот обрабатывает параллельно (1 = как в run_polling)")
+    p.add_argument("--step-timeout", type=float, default=30.0, help="сколько ждать ответа бота на шаг, с")
+    p.add_argument("--sample-interval", type=float, default=0.5, help="период замера user_data, с")
+    p.add_argument("--conversation-timeout", type=float, default=CONVERSATION_TIMEOUT,
+                   help="таймаут брошенного диалога, с")
+    p.add_argument("--user-data-ttl", type=float, default=USER_DATA_TTL,
+                   help="через сколько секунд молчания user_data выселяется")
+    p.add_argument("--user-data-max", type=int, default=USER_DATA_MAX_ENTRIES,
+                   help="жёсткий лимит записей в user_data")
+    p.add_argument("--sweep-interval", type=float, default=SWEEP_INTERVAL, help="период уборки user_data, с")
+    p.add_argument("--linger", type=float, default=0.0,
+                   help="сколько секунд подождать после последнего пользователя (чтобы увидеть уборку)")
+    p.add_argument("--seed", type=int, default=None)
+    return p.parse_args(argv)
+
+
+def main():
+    asyncio.run(run(parse_args()))
+
+
+if __name__ == "__main__":
+    main()
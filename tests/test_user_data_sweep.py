@@ -0,0 +1,200 @@
+import asyncio
+import logging
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+import pytest
+from telegram.ext import Application, CallbackContext, ConversationHandler
+
+import bot
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(bot, "time", clock)
+    return clock
+
+
+def make_app(**kwargs) -> Application:
+    app = Application.builder().token("123:TEST").updater(None).build()
+    add_kwargs = {"conversation_timeout": 100, "user_data_ttl": 200, "user_data_max_entries": 1000}
+    add_kwargs.update(kwargs)
+    bot.add_handlers(app, **add_kwargs)
+    return app
+
+
+def make_update(user_id: int, text: str = ""):
+    return SimpleNamespace(
+        effective_user=SimpleNamespace(id=user_id),
+        message=SimpleNamespace(text=text, reply_text=AsyncMock()),
+        callback_query=None,
+    )
+
+
+def visit(app: Application, user_id: int, text: str = ""):
+    # Как будто пришёл апдейт: touch_user в group=-1 отмечает активность
+    update = make_update(user_id, text)
+    context = CallbackContext(app, user_id=user_id)
+    asyncio.run(bot.touch_user(update, context))
+    return update, context
+
+
+def finished_user(app: Application, user_id: int):
+    _, context = visit(app, user_id)
+    context.user_data["delivery"] = "карго"
+    bot.end_conversation(make_update(user_id), context)
+
+
+def live_user(app: Application, user_id: int):
+    update, context = visit(app, user_id)
+    asyncio.run(bot.cmd_start(update, context))
+    context.user_data.update({"delivery": "карго", "cargo_type": "Игрушки", "days": 15})
+
+
+def sweep_context(app: Application, ttl: float = 200, max_entries: int = 1000, batch: int = 2):
+    return SimpleNamespace(application=app, job=SimpleNamespace(data=(ttl, max_entries, batch)))
+
+
+def sweep(app: Application, **kwargs):
+    asyncio.run(bot.sweep_user_data(sweep_context(app, **kwargs)))
+
+
+def test_idle_users_evicted_oldest_first(clock):
+    app = make_app()
+    for user_id, seen in [(1, 0), (2, 10), (3, 20)]:
+        clock.now = seen
+        finished_user(app, user_id)
+
+    clock.now = 215
+    sweep(app)
+
+    assert set(app.user_data) == {3}
+    assert list(app.bot_data["last_seen"]) == [3]
+    assert bot.user_data_metrics(app)["evicted_idle"] == 2
+
+
+def test_cap_is_respected_and_evicts_oldest(clock):
+    app = make_app()
+    for user_id in range(1, 6):
+        clock.now = user_id
+        finished_user(app, user_id)
+
+    sweep(app, max_entries=2)
+
+    assert set(app.user_data) == {4, 5}
+    assert bot.user_data_metrics(app)["evicted_cap"] == 3
+
+
+def test_cap_leaves_live_conversations_alone(clock):
+    app = make_app()
+    live_user(app, 1)
+    for user_id in (2, 3):
+        clock.now = user_id
+        finished_user(app, user_id)
+
+    sweep(app, max_entries=2)
+
+    assert set(app.user_data) == {1, 3}
+    assert app.user_data[1]["days"] == 15
+    assert bot.user_data_metrics(app)["live_conversations"] == 1
+
+
+def test_evicted_live_conversation_is_sent_back_to_start(clock):
+    app = make_app()
+    live_user(app, 1)
+    finished_user(app, 2)
+
+    # Места нет даже для живого диалога
+    sweep(app, max_entries=0)
+    assert 1 not in app.user_data
+
+    update, context = visit(app, 1, text="300")
+    state = asyncio.run(bot.ask_weight(update, context))
+
+    assert state == ConversationHandler.END
+    reply = update.message.reply_text.await_args.args[0]
+    assert "/start" in reply
+    assert "Ошибка" not in reply
+    assert bot.user_data_metrics(app)["live_conversations"] == 0
+
+
+def test_cap_counts_only_real_user_data_entries(clock):
+    app = make_app()
+    # Бесхозный текст вне диалога: есть в last_seen, но записи user_data нет
+    for user_id in (1, 2, 3):
+        clock.now = user_id
+        visit(app, user_id)
+    for user_id in (4, 5, 6):
+        clock.now = user_id
+        finished_user(app, user_id)
+
+    sweep(app, max_entries=1)
+
+    assert set(app.user_data) == {6}
+    assert bot.user_data_metrics(app)["evicted_cap"] == 2
+
+
+def test_cap_skips_user_active_during_yield(clock):
+    app = make_app()
+    for user_id in range(1, 5):
+        clock.now = user_id
+        finished_user(app, user_id)
+
+    async def run():
+        async def user_2_writes():
+            # Выполнится, когда уборка отдаст управление после первого выселения
+            clock.now = 10
+            await bot.touch_user(make_update(2), CallbackContext(app, user_id=2))
+
+        await asyncio.gather(
+            bot.sweep_user_data(sweep_context(app, max_entries=2, batch=1)),
+            user_2_writes(),
+        )
+
+    asyncio.run(run())
+
+    assert set(app.user_data) == {2, 4}
+
+
+def test_timeout_after_cap_eviction_leaves_no_orphan(clock):
+    app = make_app()
+    live_user(app, 1)
+    sweep(app, max_entries=0)
+
+    # Пользователь не вернулся, диалог завершается по таймауту
+    update = make_update(1)
+    asyncio.run(bot.on_timeout(update, CallbackContext(app, user_id=1)))
+
+    assert dict(app.user_data) == {}
+    assert bot.user_data_metrics(app)["live_conversations"] == 0
+
+
+def test_on_timeout_clears_user_data(clock):
+    app = make_app()
+    live_user(app, 1)
+    update, context = visit(app, 1)
+
+    asyncio.run(bot.on_timeout(update, context))
+
+    assert context.user_data == {}
+    metrics = bot.user_data_metrics(app)
+    assert metrics["timed_out"] == 1
+    assert metrics["live_conversations"] == 0
+
+
+def test_ttl_raised_to_conversation_timeout(caplog):
+    with caplog.at_level(logging.WARNING, logger="bot"):
+        app = make_app(conversation_timeout=900, user_data_ttl=300, sweep_interval=60)
+
+    ttl, _, _ = app.job_queue.jobs()[0].data
+    assert ttl == 960
+    assert "USER_DATA_TTL" in caplog.text